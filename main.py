@@ -1,19 +1,26 @@
 import asyncio
-from typing import Any, Dict, List, Optional, Tuple
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
 
 import sys
 import os
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from loguru import logger
 import aiohttp
+from aiohttp import web
+import orjson
 from dotenv import load_dotenv
 import aiosqlite
 from aiogram import Bot, Dispatcher, Router
 from aiogram.filters import Command
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
 from aiogram.types import BufferedInputFile
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram import types
 
 logger.remove()
@@ -32,6 +39,42 @@ logger.add(
     compression="zip",
 )
 
+load_dotenv()
+
+
+def _env_int(name: str, default: int, maximum: Optional[int] = None) -> int:
+    raw = os.getenv(name)
+    value = default
+    if raw is not None:
+        try:
+            value = int(raw)
+        except ValueError:
+            logger.error(f"{name} must be an integer, got {raw!r}; using {default}")
+    value = max(1, value)
+    return value if maximum is None else min(value, maximum)
+
+
+CONNECTIONS_PER_HOST = 8
+IPFS_CONCURRENCY = _env_int("IPFS_CONCURRENCY", 6, CONNECTIONS_PER_HOST)
+API_CONCURRENCY = _env_int("API_CONCURRENCY", CONNECTIONS_PER_HOST, CONNECTIONS_PER_HOST)
+ENRICH_CONCURRENCY = _env_int("ENRICH_CONCURRENCY", 8)
+_ipfs_sem = asyncio.Semaphore(IPFS_CONCURRENCY)
+_api_sem = asyncio.Semaphore(API_CONCURRENCY)
+
+POLL_INTERVAL = 10.0
+POLL_MAX_INTERVAL = 60.0
+IDLE_TICKS_PER_STEP = 3
+
+
+_TZ = ZoneInfo("Europe/Warsaw")
+
+
+def _now_str() -> str:
+    return datetime.now(_TZ).strftime("%d.%m.%Y %H:%M:%S")
+
+
+def _now_hms() -> str:
+    return datetime.now(_TZ).strftime("%H:%M:%S")
 
 
 def _build_headers() -> Dict[str, str]:
@@ -47,9 +90,9 @@ async def fetch_json(
     max_attempts = 5
     for attempt in range(max_attempts):
         try:
-            async with session.get(url, params=params, headers=_build_headers()) as resp:
+            async with _api_sem, session.get(url, params=params, headers=_build_headers()) as resp:
                 if resp.status == 200:
-                    return await resp.json()
+                    return await resp.json(loads=orjson.loads)
                 if attempt == max_attempts - 1:
                     logger.info(f"Non-200 response {resp.status} for {url}")
         except asyncio.CancelledError:
@@ -61,14 +104,15 @@ async def fetch_json(
     return {}
 
 async def post_json(
-    session: aiohttp.ClientSession, url: str, payload: Dict[str, Any]
+    session: aiohttp.ClientSession, url: str, payload: Union[Dict[str, Any], bytes]
 ) -> Any:
+    body = payload if isinstance(payload, bytes) else orjson.dumps(payload)
     max_attempts = 5
     for attempt in range(max_attempts):
         try:
-            async with session.post(
+            async with _api_sem, session.post(
                 url,
-                json=payload,
+                data=body,
                 headers={
                     "accept": "*/*",
                     "accept-language": "en-US,en;q=0.9",
@@ -87,7 +131,7 @@ async def post_json(
                 },
             ) as resp:
                 if resp.status == 200:
-                    return await resp.json()
+                    return await resp.json(loads=orjson.loads)
                 if attempt == max_attempts - 1:
                     logger.info(f"Non-200 response {resp.status} for {url}")
         except asyncio.CancelledError:
@@ -98,11 +142,29 @@ async def post_json(
         await asyncio.sleep(1.5 * (attempt + 1))
     return {}
 
-async def extract_image_url(item: Dict[str, Any]) -> Optional[str]:
-    props = item.get("properties") or {}
-    entries: List[Dict[str, Any]] = props.get("mediaEntries") or []
+class _ItemView:
+    __slots__ = ("raw", "props", "meta", "entries", "contents", "attrs", "order", "ownership", "take", "asset_class")
+
+    def __init__(self, item: Dict[str, Any]) -> None:
+        self.raw = item
+        self.props: Dict[str, Any] = item.get("properties") or {}
+        self.meta: Dict[str, Any] = item.get("meta") or {}
+        entries = self.props.get("mediaEntries") or []
+        self.entries: List[Dict[str, Any]] = entries if isinstance(entries, list) else []
+        contents = self.meta.get("content") or []
+        self.contents: List[Dict[str, Any]] = contents if isinstance(contents, list) else []
+        attrs = self.props.get("attributes") or []
+        self.attrs: List[Dict[str, Any]] = attrs if isinstance(attrs, list) else []
+        self.order: Dict[str, Any] = item.get("bestSellOrder") or item.get("bestSell") or {}
+        self.ownership: Dict[str, Any] = item.get("ownership") or {}
+        self.take: Dict[str, Any] = self.order.get("take") or {}
+        asset_type = self.take.get("assetType") or {}
+        self.asset_class: str = (asset_type.get("assetClass") or "").upper()
+
+def extract_image_url(view: _ItemView) -> Optional[str]:
+    entries = view.entries
     preferred_order = ("ORIGINAL", "BIG", "PREVIEW")
-    if isinstance(entries, list) and entries:
+    if entries:
         for rep in preferred_order:
             for m in entries:
                 if (m.get("contentType") or "").upper() == "IMAGE" and (m.get("sizeType") or "").upper() == rep and m.get("url"):
@@ -111,8 +173,9 @@ async def extract_image_url(item: Dict[str, Any]) -> Optional[str]:
             u = m.get("url")
             if isinstance(u, str) and u:
                 return _normalize_ipfs(u)
-    meta = item.get("meta") or {}
-    contents: List[Dict[str, Any]] = meta.get("content") or []
+    item = view.raw
+    meta = view.meta
+    contents = view.contents
     image_contents = [c for c in contents if (c.get("@type") or "").upper() == "IMAGE"]
     for rep in ("ORIGINAL", "BIG", "PREVIEW", "PORTRAIT"):
         for c in image_contents:
@@ -125,10 +188,9 @@ async def extract_image_url(item: Dict[str, Any]) -> Optional[str]:
     return _normalize_ipfs(uri) if isinstance(uri, str) else None
 
 
-async def extract_name(item: Dict[str, Any]) -> Optional[str]:
-    props = item.get("properties") or {}
-    meta = item.get("meta") or {}
-    name = props.get("name") or meta.get("name") or item.get("name") or item.get("title")
+def extract_name(view: _ItemView) -> Optional[str]:
+    item = view.raw
+    name = view.props.get("name") or view.meta.get("name") or item.get("name") or item.get("title")
     return name if isinstance(name, str) else None
 
 
@@ -145,9 +207,10 @@ def _safe_decimal_str(value: Any, decimals: int = 18) -> Optional[str]:
     return whole if not frac else f"{whole}.{frac}"
 
 
-async def extract_price(item: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
-    order = item.get("bestSellOrder") or item.get("bestSell") or {}
-    ownership = item.get("ownership") or {}
+def extract_price(view: _ItemView) -> Tuple[Optional[str], Optional[str]]:
+    item = view.raw
+    order = view.order
+    ownership = view.ownership
     if not order and ownership:
         p = ownership.get("price")
         symbol = "ETH"
@@ -168,9 +231,8 @@ async def extract_price(item: Dict[str, Any]) -> Tuple[Optional[str], Optional[s
         return None, None
     price = order.get("price") or order.get("takePrice") or order.get("makePrice")
     currency_symbol: Optional[str] = None
-    take = order.get("take") or {}
-    asset_type = take.get("assetType") or {}
-    asset_class = (asset_type.get("assetClass") or "").upper()
+    take = view.take
+    asset_class = view.asset_class
     if asset_class in ("ETH", "NATIVE"):
         currency_symbol = "MATIC" if (item.get("blockchain") or "").upper() == "POLYGON" else "ETH"
     elif asset_class == "ERC20":
@@ -190,41 +252,59 @@ def _normalize_ipfs(uri: str) -> str:
         return f"https://ipfs.io/ipfs/{s.removeprefix('ipfs://')}"
     return s
 
+_META_TTL = 3600.0
+_META_NEGATIVE_TTL = 60.0
+_META_CACHE_MAX = 4096
+_meta_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+def _meta_cache_put(url: str, ttl: float, data: Dict[str, Any]) -> None:
+    now = time.monotonic()
+    if url not in _meta_cache and len(_meta_cache) >= _META_CACHE_MAX:
+        for key in [k for k, (expires, _) in _meta_cache.items() if expires <= now]:
+            del _meta_cache[key]
+        while len(_meta_cache) >= _META_CACHE_MAX:
+            del _meta_cache[next(iter(_meta_cache))]
+    _meta_cache[url] = (now + ttl, data)
+
 async def fetch_metadata(session: aiohttp.ClientSession, uri: Optional[str]) -> Dict[str, Any]:
     if not uri or not isinstance(uri, str):
         return {}
     url = _normalize_ipfs(uri)
+    now = time.monotonic()
+    cached = _meta_cache.get(url)
+    if cached is not None:
+        if now < cached[0]:
+            return cached[1]
+        del _meta_cache[url]
     try:
-        async with session.get(
+        async with _ipfs_sem, session.get(
             url,
             headers={"Accept": "application/json"},
             timeout=aiohttp.ClientTimeout(total=5),
         ) as resp:
             if resp.status == 200:
-                return await resp.json()
+                data = await resp.json(loads=orjson.loads)
+                if isinstance(data, dict):
+                    _meta_cache_put(url, _META_TTL, data)
+                    return data
+                return {}
+            _meta_cache_put(url, _META_NEGATIVE_TTL, {})
             return {}
     except asyncio.CancelledError:
         raise
     except Exception:
         return {}
 
-async def extract_from_metadata(session: aiohttp.ClientSession, item: Dict[str, Any]) -> Dict[str, Optional[str]]:
-    meta_block = item.get("meta") or {}
-    metadata_uri = meta_block.get("metadataUri")
+_SIZE_RANK = {"ORIGINAL": 0, "BIG": 1, "PREVIEW": 2}
+_NO_RANK = 99
+_RARITY_KEYS = frozenset({"rarity"})
+
+async def extract_from_metadata(session: aiohttp.ClientSession, view: _ItemView) -> Dict[str, Optional[str]]:
+    metadata_uri = view.meta.get("metadataUri")
     data = await fetch_metadata(session, metadata_uri)
     name = None
     image = None
     rarity = None
-    media_entries = data.get("mediaEntries") or []
-    if isinstance(media_entries, list) and media_entries:
-        preferred = ("ORIGINAL", "BIG", "PREVIEW")
-        for size in preferred:
-            for m in media_entries:
-                if (m.get("contentType") or "").upper() == "IMAGE" and (m.get("sizeType") or "").upper() == size and m.get("url"):
-                    image = _normalize_ipfs(str(m.get("url")))
-                    break
-            if image:
-                break
     for key in ("name", "title"):
         v = data.get(key)
         if isinstance(v, str):
@@ -235,36 +315,45 @@ async def extract_from_metadata(session: aiohttp.ClientSession, item: Dict[str,
         if isinstance(v, str):
             image = _normalize_ipfs(v)
             break
+    media_entries = data.get("mediaEntries") or []
+    if image is None and isinstance(media_entries, list):
+        best_rank = _NO_RANK
+        best_url = None
+        for m in media_entries:
+            url = m.get("url")
+            if not url or (m.get("contentType") or "").upper() != "IMAGE":
+                continue
+            rank = _SIZE_RANK.get((m.get("sizeType") or "").upper(), _NO_RANK)
+            if rank < best_rank:
+                best_rank, best_url = rank, url
+                if rank == 0:
+                    break
+        if best_url is not None:
+            image = _normalize_ipfs(str(best_url))
     attrs = data.get("attributes") or []
     if isinstance(attrs, list):
         for a in attrs:
-            if (a.get("key") or a.get("trait_type") or "").lower() == "rarity":
+            if (a.get("key") or a.get("trait_type") or "").lower() in _RARITY_KEYS:
                 rv = a.get("value")
                 if isinstance(rv, str):
                     rarity = rv
                 break
     return {"name": name, "image_url": image, "rarity": rarity}
 
-def extract_preview_url(item: Dict[str, Any], meta_extracted: Dict[str, Optional[str]]) -> Optional[str]:
-    props = item.get("properties") or {}
-    entries: List[Dict[str, Any]] = props.get("mediaEntries") or []
-    if isinstance(entries, list):
-        for m in entries:
-            if (m.get("contentType") or "").upper() == "IMAGE" and (m.get("sizeType") or "").upper() == "PREVIEW" and m.get("url"):
-                return _normalize_ipfs(str(m.get("url")))
+def extract_preview_url(view: _ItemView, meta_extracted: Dict[str, Optional[str]]) -> Optional[str]:
+    for m in view.entries:
+        if (m.get("contentType") or "").upper() == "IMAGE" and (m.get("sizeType") or "").upper() == "PREVIEW" and m.get("url"):
+            return _normalize_ipfs(str(m.get("url")))
     preview = meta_extracted.get("image_url")
     return preview
-def extract_rarity(item: Dict[str, Any], meta_rarity: Optional[str]) -> Optional[str]:
-    props = item.get("properties") or {}
-    attrs = props.get("attributes") or []
-    if isinstance(attrs, list):
-        for a in attrs:
-            key = a.get("key")
-            if isinstance(key, str) and key.lower() == "rarity":
-                rv = a.get("value")
-                if isinstance(rv, str):
-                    return rv
-                break
+def extract_rarity(view: _ItemView, meta_rarity: Optional[str]) -> Optional[str]:
+    for a in view.attrs:
+        key = a.get("key")
+        if isinstance(key, str) and key.lower() == "rarity":
+            rv = a.get("value")
+            if isinstance(rv, str):
+                return rv
+            break
     return meta_rarity
 
 
@@ -286,6 +375,30 @@ async def get_items_by_collection(
             break
     return items
 
+_BLOCKCHAINS = ("POLYGON",)
+_BASE_FILTER: Dict[str, Any] = {
+    "verifiedOnly": False,
+    "sort": "LOW_PRICE_FIRST",
+    "statuses": ("FIXED_PRICE",),
+    "blockchains": _BLOCKCHAINS,
+    "nsfw": True,
+    "orderSources": (),
+    "hasMetaContentOnly": True,
+}
+
+@lru_cache(maxsize=None)
+def _collection_filter(collection: str) -> Dict[str, Any]:
+    return {**_BASE_FILTER, "collections": (f"POLYGON-{collection}",)}
+
+@lru_cache(maxsize=None)
+def _rarity_search_body(collection: str, rarity: str) -> bytes:
+    return orjson.dumps(
+        {
+            "size": 30,
+            "filter": {**_collection_filter(collection), "traits": ({"key": "Rarity", "values": (rarity,)},)},
+        }
+    )
+
 async def search_items_marketplace(
     session: aiohttp.ClientSession, base: str, collection: str, page_size: int = 100, max_pages: int = 20
 ) -> List[Dict[str, Any]]:
@@ -293,19 +406,7 @@ async def search_items_marketplace(
     items: List[Dict[str, Any]] = []
     continuation: Optional[str] = None
     for _ in range(max_pages):
-        payload: Dict[str, Any] = {
-            "size": page_size,
-            "filter": {
-                "verifiedOnly": False,
-                "sort": "LOW_PRICE_FIRST",
-                "statuses": ["FIXED_PRICE"],
-                "collections": [f"POLYGON-{collection}"],
-                "blockchains": ["POLYGON"],
-                "nsfw": True,
-                "orderSources": [],
-                "hasMetaContentOnly": True,
-            },
-        }
+        payload: Dict[str, Any] = {"size": page_size, "filter": _collection_filter(collection)}
         if continuation:
             payload["continuation"] = continuation
         data = await post_json(session, url, payload)
@@ -324,33 +425,59 @@ async def search_cheapest_by_rarity(
     session: aiohttp.ClientSession, base: str, collection: str, rarity: str
 ) -> List[Dict[str, Any]]:
     url = f"{base}/items/search"
-    payload: Dict[str, Any] = {
-        "size": 30,
-        "filter": {
-            "verifiedOnly": False,
-            "sort": "LOW_PRICE_FIRST",
-            "statuses": ["FIXED_PRICE"],
-            "collections": [f"POLYGON-{collection}"],
-            "traits": [{"key": "Rarity", "values": [rarity]}],
-            "blockchains": ["POLYGON"],
-            "nsfw": True,
-            "orderSources": [],
-            "hasMetaContentOnly": True,
-        },
-    }
-    data = await post_json(session, url, payload)
+    data = await post_json(session, url, _rarity_search_body(collection, rarity))
     if isinstance(data, list):
         return data[:1]
     return (data.get("items") or [])[:1]
 
+_tx_lock = asyncio.Lock()
+
+@asynccontextmanager
+async def tx(conn: aiosqlite.Connection) -> AsyncIterator[None]:
+    async with _tx_lock:
+        await conn.execute("BEGIN")
+        try:
+            yield
+            await conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                await conn.execute("ROLLBACK")
+            raise
+
+class BulkWriteContext:
+    def __init__(self, conn: aiosqlite.Connection) -> None:
+        self.conn = conn
+        self._pending: Dict[str, List[Tuple[Any, ...]]] = {}
+        self._on_commit: List[Callable[[], None]] = []
+
+    def enqueue(self, sql: str, params: Tuple[Any, ...]) -> None:
+        self._pending.setdefault(sql, []).append(params)
+
+    def on_commit(self, callback: Callable[[], None]) -> None:
+        self._on_commit.append(callback)
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        callbacks, self._on_commit = self._on_commit, []
+        async with tx(self.conn):
+            for sql, rows in pending.items():
+                await self.conn.executemany(sql, rows)
+        for callback in callbacks:
+            callback()
+
 async def init_db(conn: aiosqlite.Connection) -> None:
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    await conn.execute("PRAGMA temp_store=MEMORY")
+    await conn.execute("PRAGMA mmap_size=67108864")
     await conn.execute(
         "CREATE TABLE IF NOT EXISTS floors (rarity TEXT PRIMARY KEY, price REAL, updated_at TEXT)"
     )
     await conn.execute(
         "CREATE TABLE IF NOT EXISTS notifications (item_id TEXT PRIMARY KEY, last_price REAL, last_at TEXT)"
     )
-    await conn.commit()
 
 async def ensure_threshold_column(conn: aiosqlite.Connection) -> None:
     async with conn.execute("PRAGMA table_info(floors)") as cur:
@@ -358,47 +485,60 @@ async def ensure_threshold_column(conn: aiosqlite.Connection) -> None:
         names = [c[1] for c in cols]
         if "threshold_percent" not in names:
             await conn.execute("ALTER TABLE floors ADD COLUMN threshold_percent REAL")
-            await conn.commit()
     await conn.execute("UPDATE floors SET threshold_percent = COALESCE(threshold_percent, 50)")
-    await conn.commit()
 
-async def get_floor(conn: aiosqlite.Connection, rarity: str) -> Optional[float]:
-    async with conn.execute("SELECT price FROM floors WHERE rarity = ?", (rarity,)) as cur:
-        row = await cur.fetchone()
-        if not row:
-            return None
-        v = row[0]
-        try:
-            return float(v)
-        except Exception:
-            return None
-
-async def set_floor(conn: aiosqlite.Connection, rarity: str, price: float) -> None:
-    ts = datetime.now(ZoneInfo("Europe/Warsaw")).strftime("%d.%m.%Y %H:%M:%S")
-    await conn.execute(
+async def load_floor_map(conn: aiosqlite.Connection) -> Dict[str, Tuple[Optional[float], float]]:
+    floor_map: Dict[str, Tuple[Optional[float], float]] = {}
+    async with conn.execute("SELECT rarity, price, threshold_percent FROM floors") as cur:
+        async for rarity, price, threshold in cur:
+            try:
+                price_f = float(price) if price is not None else None
+            except Exception:
+                price_f = None
+            try:
+                th = float(threshold) if threshold is not None else 50.0
+            except Exception:
+                th = 50.0
+            floor_map[rarity] = (price_f, th)
+    return floor_map
+
+def set_floor(ctx: BulkWriteContext, rarity: str, price: float) -> None:
+    ts = _now_str()
+    ctx.enqueue(
         "INSERT INTO floors(rarity, price, updated_at) VALUES(?, ?, ?) ON CONFLICT(rarity) DO UPDATE SET price=excluded.price, updated_at=excluded.updated_at",
         (rarity, round(price, 2), ts),
     )
-    await conn.commit()
 
-async def get_notified(conn: aiosqlite.Connection, item_id: str) -> Optional[float]:
-    async with conn.execute("SELECT last_price FROM notifications WHERE item_id = ?", (item_id,)) as cur:
-        row = await cur.fetchone()
-        if not row:
-            return None
-        v = row[0]
-        try:
-            return float(v)
-        except Exception:
-            return None
-
-async def set_notified(conn: aiosqlite.Connection, item_id: str, price: float) -> None:
-    ts = datetime.now(ZoneInfo("Europe/Warsaw")).strftime("%d.%m.%Y %H:%M:%S")
-    await conn.execute(
+_NOTIFIED_MAX_AGE = timedelta(days=7)
+_notified_mem: Dict[str, float] = {}
+
+async def load_notified(conn: aiosqlite.Connection) -> None:
+    cutoff = datetime.now(_TZ) - _NOTIFIED_MAX_AGE
+    stale: List[Tuple[str]] = []
+    _notified_mem.clear()
+    async with conn.execute("SELECT item_id, last_price, last_at FROM notifications") as cur:
+        async for item_id, last_price, last_at in cur:
+            try:
+                if datetime.strptime(last_at, "%d.%m.%Y %H:%M:%S").replace(tzinfo=_TZ) < cutoff:
+                    stale.append((item_id,))
+                    continue
+            except Exception:
+                pass
+            try:
+                _notified_mem[item_id] = float(last_price)
+            except Exception:
+                continue
+    if stale:
+        async with tx(conn):
+            await conn.executemany("DELETE FROM notifications WHERE item_id = ?", stale)
+
+def set_notified(ctx: BulkWriteContext, item_id: str, price: float) -> None:
+    ts = _now_str()
+    ctx.enqueue(
         "INSERT INTO notifications(item_id, last_price, last_at) VALUES(?, ?, ?) ON CONFLICT(item_id) DO UPDATE SET last_price=excluded.last_price, last_at=excluded.last_at",
         (item_id, round(price, 2), ts),
     )
-    await conn.commit()
+    ctx.on_commit(lambda: _notified_mem.__setitem__(item_id, round(price, 2)))
 
 async def get_threshold(conn: aiosqlite.Connection, rarity: str) -> float:
     async with conn.execute("SELECT threshold_percent FROM floors WHERE rarity = ?", (rarity,)) as cur:
@@ -410,12 +550,11 @@ async def get_threshold(conn: aiosqlite.Connection, rarity: str) -> float:
         except Exception:
             return 50.0
 
-async def set_threshold(conn: aiosqlite.Connection, rarity: str, percent: float) -> None:
-    await conn.execute(
+def set_threshold(ctx: BulkWriteContext, rarity: str, percent: float) -> None:
+    ctx.enqueue(
         "INSERT INTO floors(rarity, price, updated_at, threshold_percent) VALUES(?, ?, ?, ?) ON CONFLICT(rarity) DO UPDATE SET threshold_percent=excluded.threshold_percent",
         (rarity, None, "", percent),
     )
-    await conn.commit()
 
 def _parse_price(price_str: Optional[str]) -> Optional[float]:
     if price_str is None:
@@ -425,7 +564,32 @@ def _parse_price(price_str: Optional[str]) -> Optional[float]:
     except Exception:
         return None
 
+def _trigger_limit(floor_price: float, threshold: float) -> float:
+    return round(floor_price * (1 - threshold / 100.0), 2)
+
+def _format_price(price_usd: Optional[float], price: Optional[str]) -> Optional[str]:
+    if price_usd is not None:
+        return f"{price_usd:.2f} USD"
+    return price
+
+_RATE_TTL = 60.0
+_RATE_STALE_TTL = 300.0
+_rate_cache: Dict[str, Any] = {"ts": 0.0, "value": None}
+
 async def get_eth_usdt_rate(session: aiohttp.ClientSession) -> Optional[float]:
+    cached = _rate_cache["value"]
+    if cached is not None and time.monotonic() - _rate_cache["ts"] < _RATE_TTL:
+        return cached
+    rate = await _fetch_eth_usdt_rate(session)
+    if rate is not None:
+        _rate_cache["ts"] = time.monotonic()
+        _rate_cache["value"] = rate
+        return rate
+    if cached is not None and time.monotonic() - _rate_cache["ts"] < _RATE_STALE_TTL:
+        return cached
+    return None
+
+async def _fetch_eth_usdt_rate(session: aiohttp.ClientSession) -> Optional[float]:
     for attempt in range(3):
         try:
             async with session.get(
@@ -461,8 +625,7 @@ async def get_eth_usdt_rate(session: aiohttp.ClientSession) -> Optional[float]:
     return None
 
 def _format_caption(token_id: Optional[str], rarity: Optional[str], price: Optional[str], floor_price: Optional[float], rarible_url: Optional[str], opensea_url: Optional[str]) -> str:
-    tz = ZoneInfo("Europe/Warsaw")
-    now = datetime.now(tz).strftime("%H:%M:%S")
+    now = _now_hms()
     num = token_id or ""
     rar = rarity or ""
     pr = price or ""
@@ -479,14 +642,75 @@ def _format_caption(token_id: Optional[str], rarity: Optional[str], price: Optio
         f"🕒 <b>Time:</b> {now}"
     )
 
+def _ipfs_gateway_url(url: str) -> str:
+    if "ipfs.raribleuserdata.com/ipfs/" in url or url.startswith("ipfs://"):
+        try:
+            cid = url.split("ipfs/")[1] if "ipfs/" in url else url.removeprefix("ipfs://")
+            return f"https://ipfs.io/ipfs/{cid}"
+        except Exception:
+            return url
+    return url
+
+async def _download_image(session: aiohttp.ClientSession, url: str) -> Optional[bytes]:
+    try:
+        async with _ipfs_sem, session.get(url, timeout=aiohttp.ClientTimeout(total=8)) as resp:
+            if resp.status == 200:
+                return await resp.read()
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        pass
+    return None
+
+async def send_alert(
+    bot: Bot, session: aiohttp.ClientSession, chat_id: str, img_url: str, caption: str, filename: str
+) -> None:
+    try:
+        await bot.send_photo(chat_id=chat_id, photo=img_url, caption=caption)
+        return
+    except TelegramBadRequest:
+        pass
+    alt = _ipfs_gateway_url(img_url)
+    candidates = [alt, img_url] if alt != img_url else [img_url]
+    for url in candidates:
+        content = await _download_image(session, url)
+        if content is not None:
+            await bot.send_photo(chat_id=chat_id, photo=BufferedInputFile(content, filename), caption=caption)
+            return
+    await bot.send_message(chat_id=chat_id, text=caption)
+
+async def start_webhook(
+    dp: Dispatcher, bot: Bot, base_url: str, path: str, host: str, port: int, secret: Optional[str]
+) -> web.AppRunner:
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    logger.info(f"Webhook listening on {host}:{port}{path}")
+    try:
+        await bot.set_webhook(f"{base_url.rstrip('/')}{path}", secret_token=secret)
+    except TelegramAPIError as e:
+        logger.error(f"Failed to register webhook: {e}")
+    return runner
+
+
+async def _poll(dp: Dispatcher, bot: Bot) -> None:
+    try:
+        await bot.delete_webhook()
+    except TelegramAPIError as e:
+        logger.info(f"Failed to delete webhook before polling: {e}")
+    await dp.start_polling(bot)
+
 
 async def run() -> None:
     collection_hyphen = "0xd8156606d2bf60c12d55f561395d29ba3c5ccc63"
 
-    load_dotenv()
     marketplace_base = "https://og.rarible.com/marketplace/api/v4"
     bot_token = os.getenv("BOT_TOKEN")
     channel_id = os.getenv("CHANNEL_ID")
+    webhook_url = os.getenv("WEBHOOK_URL")
     channel_id_int: Optional[int] = None
     try:
         if channel_id and channel_id.startswith("-"):
@@ -495,16 +719,19 @@ async def run() -> None:
         channel_id_int = None
 
     timeout = aiohttp.ClientTimeout(total=30)
-    connector = aiohttp.TCPConnector(limit=16, enable_cleanup_closed=True, use_dns_cache=True, ttl_dns_cache=300)
+    connector = aiohttp.TCPConnector(limit=64, limit_per_host=CONNECTIONS_PER_HOST, enable_cleanup_closed=True, use_dns_cache=True, ttl_dns_cache=300)
     async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
         bot: Optional[Bot] = None
         if bot_token:
             bot = Bot(token=bot_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-        conn = await aiosqlite.connect("floors.db")
+        conn = await aiosqlite.connect("floors.db", isolation_level=None)
         await init_db(conn)
         await ensure_threshold_column(conn)
+        await load_notified(conn)
         rarities = ["Legendary", "Epic", "Rare", "Uncommon", "Common"]
+        wake = asyncio.Event()
         dp: Optional[Dispatcher] = None
+        webhook_runner: Optional[web.AppRunner] = None
         router: Optional[Router] = None
         if bot:
             dp = Dispatcher()
@@ -512,6 +739,7 @@ async def run() -> None:
             async def _handle_set(msg: types.Message) -> None:
                 if not msg.text:
                     return
+                wake.set()
                 txt = msg.text.strip()
                 chat_ok = True
                 if channel_id and channel_id.startswith("@") and msg.chat and msg.chat.username and ("@" + msg.chat.username) == channel_id:
@@ -548,7 +776,9 @@ async def run() -> None:
                     if not (0 < percent_val <= 100):
                         await bot.send_message(chat_id=msg.chat.id, text="Percent must be a number between 1 and 100")
                         return
-                    await set_threshold(conn, rarity_norm, percent_val)
+                    writes = BulkWriteContext(conn)
+                    set_threshold(writes, rarity_norm, percent_val)
+                    await writes.flush()
                     await bot.send_message(chat_id=msg.chat.id, text=f"Threshold updated for {rarity_norm}: {round(percent_val, 2):.2f}%")
                 except Exception:
                     logger.info("Set command error")
@@ -560,6 +790,7 @@ async def run() -> None:
                 if not msg.text:
                     return
                 logger.info("Received /current request")
+                wake.set()
                 chat_ok = True
                 if channel_id and channel_id.startswith("@") and msg.chat and msg.chat.username and ("@" + msg.chat.username) == channel_id:
                     chat_ok = True
@@ -592,27 +823,28 @@ async def run() -> None:
             router.message.register(_handle_current, Command("current"))
             router.channel_post.register(_handle_current, Command("current"))
             dp.include_router(router)
-            asyncio.create_task(dp.start_polling(bot))
+            if webhook_url:
+                webhook_runner = await start_webhook(
+                    dp,
+                    bot,
+                    webhook_url,
+                    os.getenv("WEBHOOK_PATH", "/telegram"),
+                    os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+                    _env_int("WEBHOOK_PORT", 8080),
+                    os.getenv("WEBHOOK_SECRET"),
+                )
+            else:
+                asyncio.create_task(_poll(dp, bot))
         prev_items: Dict[str, List[Dict[str, Any]]] = {r: [] for r in rarities}
 
         async def _enrich(it: Dict[str, Any], rate: Optional[float]) -> Dict[str, Any]:
-            image_url = await extract_image_url(it)
-            meta_extracted = await extract_from_metadata(session, it)
-            if not image_url:
-                image_url = meta_extracted.get("image_url")
-            preview_url = extract_preview_url(it, meta_extracted) or image_url
-            price, currency = await extract_price(it)
-            token_id = it.get("tokenId")
-            if not token_id:
-                token_id = it.get("ownership", {}).get("tokenId")
+            view = _ItemView(it)
             item_id = it.get("id")
-            rarible_url = f"https://og.rarible.com/token/{item_id}" if isinstance(item_id, str) else None
-            opensea_url = f"https://opensea.io/item/polygon/{collection_hyphen}/{token_id}" if isinstance(token_id, str) else None
-            rarity = extract_rarity(it, meta_extracted.get("rarity"))
+            price, currency = extract_price(view)
             price_val = _parse_price(price)
             price_usd: Optional[float] = None
             
-            price_eth = it.get("ownership", {}).get("priceEth")
+            price_eth = view.ownership.get("priceEth")
             if price_eth is not None:
                 try:
                      price_val_for_usd = float(price_eth)
@@ -623,6 +855,19 @@ async def run() -> None:
 
             if rate is not None and price_val_for_usd is not None:
                 price_usd = price_val_for_usd * rate
+            if price_usd is None:
+                return {"item_id": item_id, "price": price, "price_usd": None, "rarity": None}
+            image_url = extract_image_url(view)
+            token_id = it.get("tokenId")
+            if not token_id:
+                token_id = view.ownership.get("tokenId")
+            rarible_url = f"https://og.rarible.com/token/{item_id}" if isinstance(item_id, str) else None
+            opensea_url = f"https://opensea.io/item/polygon/{collection_hyphen}/{token_id}" if isinstance(token_id, str) else None
+            meta_extracted = await extract_from_metadata(session, view)
+            if not image_url:
+                image_url = meta_extracted.get("image_url")
+            preview_url = extract_preview_url(view, meta_extracted) or image_url
+            rarity = extract_rarity(view, meta_extracted.get("rarity"))
             return {
                 "image_url": image_url,
                 "preview_url": preview_url,
@@ -636,97 +881,119 @@ async def run() -> None:
                 "price_usd": price_usd,
             }
 
+        enrich_sem = asyncio.Semaphore(ENRICH_CONCURRENCY)
+
+        async def _bounded_enrich(it: Dict[str, Any], rate: Optional[float]) -> Dict[str, Any]:
+            async with enrich_sem:
+                return await _enrich(it, rate)
+
+        def _store_floor(
+            writes: BulkWriteContext,
+            floor_map: Dict[str, Tuple[Optional[float], float]],
+            limits: Dict[str, float],
+            rarity: str,
+            price: float,
+        ) -> None:
+            set_floor(writes, rarity, price)
+            th = floor_map.get(rarity, (None, 50.0))[1]
+            floor_map[rarity] = (round(price, 2), th)
+            limits[rarity] = _trigger_limit(round(price, 2), th)
+
+        async def _process_result(
+            r: Dict[str, Any],
+            floor_map: Dict[str, Tuple[Optional[float], float]],
+            limits: Dict[str, float],
+            writes: BulkWriteContext,
+            notified_rarities: set,
+        ) -> None:
+            rarity = r.get("rarity")
+            price_usd = r.get("price_usd")
+            price_str = _format_price(price_usd, r.get("price"))
+            floor_price, th = floor_map.get(rarity, (None, 50.0)) if isinstance(rarity, str) else (None, 50.0)
+            limit_cmp = limits.get(rarity) if isinstance(rarity, str) else None
+            price_cmp = round(price_usd, 2) if isinstance(price_usd, float) else None
+            if price_cmp is not None and limit_cmp is not None:
+                logger.info(f"Compare: rarity {rarity} price {price_cmp:.2f} <= limit {limit_cmp:.2f} ({round(th,2):.2f}%)")
+            if price_cmp is not None and limit_cmp is not None and price_cmp <= limit_cmp:
+                logger.info(f"Trigger: rarity {rarity} price_usd {round(price_usd, 2):.2f} floor {round(floor_price, 2):.2f} ({round(th,2):.2f}%)")
+                last_notified_price = None
+                if isinstance(r.get("item_id"), str):
+                    last_notified_price = _notified_mem.get(r["item_id"])
+                should_notify = last_notified_price is None or (isinstance(last_notified_price, float) and price_usd < last_notified_price)
+                if should_notify and bot and channel_id and r.get("image_url"):
+                    logger.info(f"Sending telegram alert for {rarity} to {channel_id}")
+                    caption = _format_caption(r.get("token_id"), rarity, price_str, floor_price, r.get("rarible_url"), r.get("opensea_url"))
+                    img_url = _normalize_ipfs(r.get("preview_url") or r.get("image_url") or "")
+                    try:
+                        fname = f"{rarity}_{r.get('token_id') or ''}.jpg"
+                        await send_alert(bot, session, channel_id, img_url, caption, fname)
+                        logger.info("Telegram message sent")
+                        if isinstance(rarity, str) and isinstance(price_usd, float):
+                            _store_floor(writes, floor_map, limits, rarity, price_usd)
+                            logger.info(f"Floor updated immediately for {rarity}: {round(price_usd, 2):.2f} USD")
+                            notified_rarities.add(rarity)
+                        if isinstance(r.get("item_id"), str) and isinstance(price_usd, float):
+                            set_notified(writes, r.get("item_id"), price_usd)
+                    except Exception:
+                        logger.info("Telegram send failed")
+            if tick == 1 and price_usd is not None and isinstance(rarity, str):
+                current_floor = floor_map.get(rarity, (None, 50.0))[0]
+                if current_floor is None:
+                    _store_floor(writes, floor_map, limits, rarity, price_usd)
+                    logger.info(f"Floor initialized for {rarity}: {round(price_usd, 2):.2f} USD")
+            if price_usd is not None and tick % 3 == 0 and isinstance(rarity, str):
+                current_floor = floor_map.get(rarity, (None, 50.0))[0]
+                if current_floor is None:
+                    _store_floor(writes, floor_map, limits, rarity, price_usd)
+                    logger.info(f"Floor updated for {rarity}: {round(price_usd, 2):.2f} USD")
+                elif rarity not in notified_rarities and price_usd >= current_floor:
+                    _store_floor(writes, floor_map, limits, rarity, price_usd)
+                    logger.info(f"Floor raised for {rarity}: {round(price_usd, 2):.2f} USD")
+
         logger.info("Initializing floors and starting watcher")
-        tick = 0
-        last_rate: Optional[float] = None
-        while True:
-            tick += 1
-            new_rate = await get_eth_usdt_rate(session)
-            if isinstance(new_rate, float):
-                last_rate = new_rate
-            rate = last_rate
-            if isinstance(rate, float):
-                logger.info(f"ETHUSDT rate: {rate:.2f}")
-            else:
-                logger.info("ETHUSDT rate unavailable")
-            tasks = [search_cheapest_by_rarity(session, marketplace_base, collection_hyphen, r) for r in rarities]
-            logger.info("Fetching cheapest items per rarity")
-            per_rarity: List[List[Dict[str, Any]]] = await asyncio.gather(*tasks)
-            items: List[Dict[str, Any]] = []
-            for i, lst in enumerate(per_rarity):
-                rname = rarities[i]
-                use_list = lst if lst else prev_items.get(rname, [])
-                prev_items[rname] = use_list
-                items.extend(use_list)
-            logger.info(f"Items fetched: {len(items)}")
-            results: List[Dict[str, Any]] = await asyncio.gather(*[ _enrich(it, rate) for it in items ])
-            notified_rarities: set = set()
-            for r in results:
-                rarity = r.get("rarity")
-                price_usd = r.get("price_usd")
-                price_str = f"{price_usd:.2f} USD" if isinstance(price_usd, float) else r.get("price")
-                floor_price = await get_floor(conn, rarity) if isinstance(rarity, str) else None
-                th = await get_threshold(conn, rarity) if isinstance(rarity, str) else 50.0
-                if isinstance(price_usd, float) and isinstance(floor_price, float):
-                    price_cmp = round(price_usd, 2)
-                    limit_cmp = round(floor_price * (1 - th / 100.0), 2)
-                    logger.info(f"Compare: rarity {rarity} price {price_cmp:.2f} <= limit {limit_cmp:.2f} ({round(th,2):.2f}%)")
-                if price_usd is not None and floor_price is not None and round(price_usd, 2) <= round(floor_price * (1 - th / 100.0), 2):
-                    logger.info(f"Trigger: rarity {rarity} price_usd {round(price_usd, 2):.2f} floor {round(floor_price, 2):.2f} ({round(th,2):.2f}%)")
-                    last_notified_price = None
-                    if isinstance(r.get("item_id"), str):
-                        last_notified_price = await get_notified(conn, r.get("item_id"))
-                    should_notify = last_notified_price is None or (isinstance(last_notified_price, float) and price_usd < last_notified_price)
-                    if should_notify and bot and channel_id and r.get("image_url"):
-                        logger.info(f"Sending telegram alert for {rarity} to {channel_id}")
-                        caption = _format_caption(r.get("token_id"), rarity, price_str, floor_price, r.get("rarible_url"), r.get("opensea_url"))
-                        img_url = _normalize_ipfs(r.get("preview_url") or r.get("image_url") or "")
-                        try:
-                            async with session.get(img_url, timeout=aiohttp.ClientTimeout(total=8)) as ir:
-                                if ir.status == 200:
-                                    content = await ir.read()
-                                    fname = f"{rarity}_{r.get('token_id') or ''}.jpg"
-                                    photo = BufferedInputFile(content, fname)
-                                    await bot.send_photo(chat_id=channel_id, photo=photo, caption=caption)
-                                else:
-                                    alt = img_url
-                                    if "ipfs.raribleuserdata.com/ipfs/" in img_url or img_url.startswith("ipfs://"):
-                                        try:
-                                            cid = img_url.split("ipfs/")[1] if "ipfs/" in img_url else img_url.removeprefix("ipfs://")
-                                            alt = f"https://ipfs.io/ipfs/{cid}"
-                                        except Exception:
-                                            alt = img_url
-                                    async with session.get(alt, timeout=aiohttp.ClientTimeout(total=8)) as ar:
-                                        if ar.status == 200:
-                                            content = await ar.read()
-                                            fname = f"{rarity}_{r.get('token_id') or ''}.jpg"
-                                            photo = BufferedInputFile(content, fname)
-                                            await bot.send_photo(chat_id=channel_id, photo=photo, caption=caption)
-                                        else:
-                                            await bot.send_message(chat_id=channel_id, text=caption)
-                            logger.info("Telegram message sent")
-                            if isinstance(rarity, str) and isinstance(price_usd, float):
-                                await set_floor(conn, rarity, price_usd)
-                                logger.info(f"Floor updated immediately for {rarity}: {round(price_usd, 2):.2f} USD")
-                                notified_rarities.add(rarity)
-                            if isinstance(r.get("item_id"), str) and isinstance(price_usd, float):
-                                await set_notified(conn, r.get("item_id"), price_usd)
-                        except Exception:
-                            logger.info("Telegram send failed")
-                if tick == 1 and price_usd is not None and isinstance(rarity, str):
-                    current_floor = await get_floor(conn, rarity)
-                    if current_floor is None:
-                        await set_floor(conn, rarity, price_usd)
-                        logger.info(f"Floor initialized for {rarity}: {round(price_usd, 2):.2f} USD")
-                if price_usd is not None and tick % 3 == 0 and isinstance(rarity, str):
-                    current_floor = await get_floor(conn, rarity)
-                    if current_floor is None:
-                        await set_floor(conn, rarity, price_usd)
-                        logger.info(f"Floor updated for {rarity}: {round(price_usd, 2):.2f} USD")
-                    elif rarity not in notified_rarities and price_usd >= current_floor:
-                        await set_floor(conn, rarity, price_usd)
-                        logger.info(f"Floor raised for {rarity}: {round(price_usd, 2):.2f} USD")
-            await asyncio.sleep(10)
+        try:
+            tick = 0
+            idle_ticks = 0
+            last_seen: Dict[str, Optional[str]] = {}
+            while True:
+                tick += 1
+                rate = await get_eth_usdt_rate(session)
+                if isinstance(rate, float):
+                    logger.info(f"ETHUSDT rate: {rate:.2f}")
+                else:
+                    logger.info("ETHUSDT rate unavailable")
+                tasks = [search_cheapest_by_rarity(session, marketplace_base, collection_hyphen, r) for r in rarities]
+                logger.info("Fetching cheapest items per rarity")
+                per_rarity: List[List[Dict[str, Any]]] = await asyncio.gather(*tasks)
+                items: List[Dict[str, Any]] = []
+                for i, lst in enumerate(per_rarity):
+                    rname = rarities[i]
+                    use_list = lst if lst else prev_items.get(rname, [])
+                    prev_items[rname] = use_list
+                    items.extend(use_list)
+                logger.info(f"Items fetched: {len(items)}")
+                async with asyncio.TaskGroup() as tg:
+                    enrich_tasks = [tg.create_task(_bounded_enrich(it, rate)) for it in items]
+                results: List[Dict[str, Any]] = [t.result() for t in enrich_tasks]
+                notified_rarities: set = set()
+                writes = BulkWriteContext(conn)
+                floor_map = await load_floor_map(conn)
+                limits = {rname: _trigger_limit(p, th) for rname, (p, th) in floor_map.items() if p is not None}
+                await asyncio.gather(*[_process_result(r, floor_map, limits, writes, notified_rarities) for r in results])
+                await writes.flush()
+                seen = {r["item_id"]: r.get("price") for r in results if isinstance(r.get("item_id"), str)}
+                idle_ticks = idle_ticks + 1 if seen == last_seen else 0
+                last_seen = seen
+                delay = min(POLL_INTERVAL * 2 ** (idle_ticks // IDLE_TICKS_PER_STEP), POLL_MAX_INTERVAL)
+                try:
+                    await asyncio.wait_for(wake.wait(), timeout=delay)
+                    idle_ticks = 0
+                except asyncio.TimeoutError:
+                    pass
+                wake.clear()
+        finally:
+            if webhook_runner is not None:
+                await webhook_runner.cleanup()
 
 
 if __name__ == "__main__":